@@ -1,3 +1,4 @@
+import functools
 import itertools as it
 import logging
 from collections import OrderedDict
@@ -6,11 +7,36 @@ import ConfigSpace
 import numpy as np
 import pandas as pd
 import pyrfr.regression as reg
-import pyrfr.util
 from ConfigSpace.hyperparameters import CategoricalHyperparameter, UniformFloatHyperparameter, \
     NumericalHyperparameter, Constant, OrdinalHyperparameter
 
 
+def _weighted_variance(values, weights):
+    """
+    Returns the weighted population variance of values along the last axis, ignoring nan values
+
+    Parameters
+    ----------
+    values: np.array
+        values (e.g. predictions on a grid), nans are skipped
+    weights: np.array
+        non-negative weight of each value, same shape as values
+
+    Returns
+    -------
+    float or np.array
+        the variance, or nan where the weights of all non-nan values sum up to zero
+    """
+    valid = ~np.isnan(values)
+    values = np.where(valid, values, 0)
+    weights = np.where(valid, weights, 0)
+    total_weight = weights.sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        deviations = values - (np.einsum('...i,...i->...', values, weights) / total_weight)[..., np.newaxis]
+        variance = np.einsum('...i,...i->...', deviations * deviations, weights) / total_weight
+    return np.where(total_weight > 0, variance, np.nan)
+
+
 class fANOVA(object):
     def __init__(self, X, Y, config_space=None,
                  n_trees=16, seed=None, bootstrapping=True,
@@ -74,11 +100,14 @@ class fANOVA(object):
                                 "'get_hyperparameters'-method. We recommend to use labeled pandas dataframes to "
                                 "avoid any problems.")
 
+        # bounds of the data, computed once for building and checking the ConfigSpace
+        col_mins, col_maxs = X.min(axis=0), X.max(axis=0)
+
         # if no ConfigSpace is specified, let's build one with all continuous variables
         if config_space is None:
             # if no info is given, use min and max values of each variable as bounds
             config_space = ConfigSpace.ConfigurationSpace()
-            for i, (mn, mx) in enumerate(zip(np.min(X, axis=0), np.max(X, axis=0))):
+            for i, (mn, mx) in enumerate(zip(col_mins, col_maxs)):
                 config_space.add_hyperparameter(UniformFloatHyperparameter("x_%03i" % i, mn, mx))
 
         self.percentiles = np.percentile(Y, range(0, 100))
@@ -94,16 +123,15 @@ class fANOVA(object):
             raise RuntimeError('Number of parameters in ConfigSpace object does not match input X')
         for i in range(len(self.cs_params)):
             if isinstance(self.cs_params[i], NumericalHyperparameter):
-                if (np.max(X[:, i]) > self.cs_params[i].upper) or \
-                        (np.min(X[:, i]) < self.cs_params[i].lower):
+                if (col_maxs[i] > self.cs_params[i].upper) or (col_mins[i] < self.cs_params[i].lower):
                     raise RuntimeError('Some sample values from X are not in the given interval')
             elif isinstance(self.cs_params[i], CategoricalHyperparameter):
-                unique_vals = set(X[:, i])
+                unique_vals = np.unique(X[:, i])
                 if len(unique_vals) > len(self.cs_params[i].choices):
                     raise RuntimeError("There are some categoricals missing in the ConfigSpace specification for "
                                        "hyperparameter %s:" % self.cs_params[i].name)
             elif isinstance(self.cs_params[i], OrdinalHyperparameter):
-                unique_vals = set(X[:, i])
+                unique_vals = np.unique(X[:, i])
                 if len(unique_vals) > len(self.cs_params[i].sequence):
                     raise RuntimeError("There are some sequence-options missing in the ConfigSpace specification for "
                                        "hyperparameter %s:" % self.cs_params[i].name)
@@ -166,9 +194,10 @@ class fANOVA(object):
             else:
                 data.set_bounds_of_feature(i, mn, mx)
 
-        for i in range(len(Y)):
-            self.logger.debug("process datapoint: %s", str(X[i].tolist()))
-            data.add_data_point(X[i].tolist(), Y[i])
+        # convert to python lists once, the data container copies every data point anyway
+        self.logger.debug("process %i datapoints", len(Y))
+        for x, y in zip(X.tolist(), Y.tolist()):
+            data.add_data_point(x, y)
 
         forest.fit(data, rng)
 
@@ -184,12 +213,17 @@ class fANOVA(object):
         self.all_midpoints = []
         self.all_sizes = []
 
+        # bounds of the continuous parameters (the upper bound is nan for categoricals)
+        lowers = np.array([mn for mn, _ in pcs], dtype=np.float64)
+        uppers = np.array([mx for _, mx in pcs], dtype=np.float64)
+        is_categorical = np.isnan(uppers)
+
         # compute midpoints and interval sizes for variables in each tree
         for tree_split_values in forest_split_values:
             sizes = []
             midpoints = []
             for i, split_vals in enumerate(tree_split_values):
-                if np.isnan(pcs[i][1]):  # categorical parameter
+                if is_categorical[i]:
                     # check if the tree actually splits on this parameter
                     if len(split_vals) > 0:
                         midpoints.append(split_vals)
@@ -201,23 +235,40 @@ class fANOVA(object):
                         sizes.append((pcs[i][0],))
                 else:
                     # add bounds to split values
-                    sv = np.array([pcs[i][0]] + list(split_vals) + [pcs[i][1]])
-                    # compute midpoints and sizes
-                    midpoints.append((1 / 2) * (sv[1:] + sv[:-1]))
-                    sizes.append(sv[1:] - sv[:-1])
+                    sv = np.concatenate(([lowers[i]],
+                                         np.fromiter(split_vals, dtype=np.float64, count=len(split_vals)),
+                                         [uppers[i]]))
+                    # compute sizes and midpoints (in place, sv is not needed afterwards)
+                    size = np.diff(sv)
+                    midpoint = sv[:-1]
+                    midpoint += 0.5 * size
+                    midpoints.append(midpoint)
+                    sizes.append(size)
 
             self.all_midpoints.append(midpoints)
             self.all_sizes.append(sizes)
 
-        # capital V in the paper
-        self.trees_total_variances = []
-        # dict of lists where the keys are tuples of the dimensions
-        # and the value list contains \hat{f}_U for the individual trees
+        # padded storage of the midpoints and sizes of all trees, the intervals of tree t for dimension d
+        # are the first n_intervals[t, d] entries along the last axis (midpoints are padded with nan, sizes with 0)
+        self._n_intervals = np.array([[len(m) for m in midpoints] for midpoints in self.all_midpoints], dtype=np.intp)
+        tensor_shape = self._n_intervals.shape + (self._n_intervals.max(),)
+        self._midpoints_tensor = np.full(tensor_shape, np.nan)
+        self._sizes_tensor = np.zeros(tensor_shape)
+        for tree_idx, (midpoints, sizes) in enumerate(zip(self.all_midpoints, self.all_sizes)):
+            for dim, n in enumerate(self._n_intervals[tree_idx]):
+                self._midpoints_tensor[tree_idx, dim, :n] = midpoints[dim]
+                self._sizes_tensor[tree_idx, dim, :n] = sizes[dim]
+
+        # dicts of arrays where the keys are tuples of the dimensions
+        # and the value array contains \hat{f}_U for the individual trees
         # reset all the variance fractions computed
         self.trees_variance_fractions = {}
         self.V_U_total = {}
         self.V_U_individual = {}
 
+        # sample buffer shared by all per-tree predictions, dimensions that are not set are nan (i.e. marginalized)
+        self._scratch_sample = [np.nan] * self.n_dims
+
         self.cutoffs = cutoffs
         self.set_cutoffs(cutoffs)
 
@@ -246,8 +297,139 @@ class fANOVA(object):
         self.V_U_total = {}
         self.V_U_individual = {}
 
-        # recompute the trees' total variance
-        self.trees_total_variance = self.the_forest.get_trees_total_variances()
+        # recompute the trees' total variance (capital V in the paper)
+        self.trees_total_variance = np.array(self.the_forest.get_trees_total_variances(), dtype=np.float64)
+        # trees without any variance are excluded when computing the importance
+        self._non_zero_trees = np.flatnonzero(self.trees_total_variance)
+
+    def _tree_intervals(self, tree_idx, dim):
+        """
+        Returns the midpoints and sizes of the intervals a single tree splits a dimension into
+
+        Parameters
+        ----------
+        tree_idx: int
+            Index of the tree in the forest
+        dim: int
+            Index of the dimension in the ConfigSpace
+
+        Returns
+        -------
+        tuple
+            views on the midpoints and the corresponding sizes
+        """
+        n = self._n_intervals[tree_idx, dim]
+        return self._midpoints_tensor[tree_idx, dim, :n], self._sizes_tensor[tree_idx, dim, :n]
+
+    def _predict_tree_marginal(self, tree_idx, dimensions, values):
+        """
+        Returns the marginal prediction of a single tree
+
+        Parameters
+        ----------
+        tree_idx: int
+            Index of the tree in the forest
+        dimensions: tuple
+            Sorted indices of the dimensions that are set, all others are marginalized over
+        values: list
+            Values of the given dimensions
+
+        Returns
+        -------
+        tuple
+            mean of the marginal prediction and the corresponding sum of weights
+        """
+        # only touch the set dimensions of the shared sample and reset them afterwards
+        sample = self._scratch_sample
+        for dim, value in zip(dimensions, values):
+            sample[dim] = value
+        try:
+            ls = self.the_forest.marginal_prediction_stat_of_tree(tree_idx, sample)
+        finally:
+            for dim in dimensions:
+                sample[dim] = np.nan
+        return ls.mean(), ls.sum_of_weights()
+
+    def _tree_marginal_predictions(self, tree_idx, dimensions, grid):
+        """
+        Returns the marginal predictions of a single tree for all points of a grid
+
+        Parameters
+        ----------
+        tree_idx: int
+            Index of the tree in the forest
+        dimensions: tuple
+            Sorted indices of the dimensions that are set by the grid, all others are marginalized over
+        grid: np.array
+            Matrix of shape (number of points, len(dimensions)) with the values for the given dimensions
+
+        Returns
+        -------
+        tuple
+            arrays with the means of the marginal predictions and the corresponding sums of weights
+        """
+        means = np.empty(len(grid))
+        sums_of_weights = np.empty(len(grid))
+        # the set dimensions are the same for all points, so they are passed once with each row of values
+        for i, values in enumerate(grid.tolist()):
+            means[i], sums_of_weights[i] = self._predict_tree_marginal(tree_idx, dimensions, values)
+        return means, sums_of_weights
+
+    def _tree_marginal_variance(self, tree_idx, dimensions):
+        """
+        Returns the variance of the marginal of selected parameters for a single tree
+
+        Note that the predictions write to the shared sample buffer, so this is not thread-safe.
+
+        Parameters
+        ----------
+        tree_idx: int
+            Index of the tree in the forest
+        dimensions: tuple
+            Sorted indices of ConfigSpace for the selected parameters (starts with 0)
+
+        Returns
+        -------
+        float
+            the total variance V_U of the tree's marginal, nan if all predictions are cut off
+        """
+        # collect all the midpoints and corresponding sizes for that tree
+        midpoints, sizes = zip(*[self._tree_intervals(tree_idx, dim) for dim in dimensions])
+
+        # all combinations of the midpoints, one row per grid point
+        grid = np.stack([axis.ravel() for axis in np.meshgrid(*midpoints, indexing='ij')], axis=1)
+        # size of each grid cell, i.e. the product of its interval sizes (in the same order as the grid)
+        cell_sizes = functools.reduce(np.multiply.outer, sizes).ravel()
+
+        # make prediction for all midpoints and weigh them by the corresponding size
+        means, sums_of_weights = self._tree_marginal_predictions(tree_idx, dimensions, grid)
+        weights = cell_sizes * sums_of_weights
+        return _weighted_variance(means, weights)
+
+    def _main_effect_variances(self, dim):
+        """
+        Returns the variances of the marginal of a single parameter for all trees
+
+        The predictions are padded to the same number of intervals for all trees, so that the
+        variances of all trees are reduced at once.
+
+        Parameters
+        ----------
+        dim: int
+            Index of the parameter in the ConfigSpace
+
+        Returns
+        -------
+        np.array
+            the total variance V_U of every tree's marginal, nan if all predictions of a tree are cut off
+        """
+        midpoints = self._midpoints_tensor[:, dim, :]
+        means = np.full(midpoints.shape, np.nan)
+        sums_of_weights = np.zeros(midpoints.shape)
+        for tree_idx, n in enumerate(self._n_intervals[:, dim]):
+            means[tree_idx, :n], sums_of_weights[tree_idx, :n] = \
+                self._tree_marginal_predictions(tree_idx, (dim,), midpoints[tree_idx, :n, np.newaxis])
+        return _weighted_variance(means, self._sizes_tensor[:, dim, :] * sums_of_weights)
 
     def __compute_marginals(self, dimensions):
         """
@@ -258,58 +440,72 @@ class fANOVA(object):
         dimensions: tuple
             Contains the indices of ConfigSpace for the selected parameters (starts with 0)
         """
-        dimensions = tuple(dimensions)
+        # the marginals do not depend on the order of the dimensions, so they are stored under the sorted tuple
+        dimensions = tuple(sorted(dimensions))
+
+        # visit all subsets bottom up (by increasing order), that way all lower order
+        # terms of a subset have been computed before the subset itself
+        for k in range(1, len(dimensions) + 1):
+            for sub_dims in it.combinations(dimensions, k):
+                # check if values has been previously computed
+                if sub_dims not in self.V_U_individual:
+                    self._compute_subset_marginal(sub_dims)
+
+    def _compute_subset_marginal(self, dimensions):
+        """
+        Computes V_U_total and V_U_individual of selected parameters for all trees
 
-        # check if values has been previously computed
-        if dimensions in self.V_U_individual:
-            return
+        Parameters
+        ----------
+        dimensions: tuple
+            Sorted indices of ConfigSpace for the selected parameters (starts with 0), the marginals
+            of all their proper subsets have to be computed already
+        """
+        # line 10 in algorithm 2
+        # note that V_U^2 can be computed by var(\hat a)^2 - \sum_{subU} var(f_subU)^2
+        # which is why, \hat{f} is never computed in the code, but
+        # appears in the pseudocode
+        if len(dimensions) == 1:
+            V_U_total = self._main_effect_variances(dimensions[0])
+        else:
+            V_U_total = np.array([self._tree_marginal_variance(tree_idx, dimensions)
+                                  for tree_idx in range(len(self.all_midpoints))])
 
-        # otherwise make sure all lower order marginals have been
-        # computed, if not compute them
+        V_U_individual = V_U_total.copy()
         for k in range(1, len(dimensions)):
             for sub_dims in it.combinations(dimensions, k):
-                if sub_dims not in self.V_U_total:
-                    self.__compute_marginals(sub_dims)
-
-        # now all lower order terms have been computed
-        self.V_U_individual[dimensions] = []
-        self.V_U_total[dimensions] = []
-        for tree_idx in range(len(self.all_midpoints)):
-            # collect all the midpoints and corresponding sizes for that tree
-            midpoints = [self.all_midpoints[tree_idx][dim] for dim in dimensions]
-            sizes = [self.all_sizes[tree_idx][dim] for dim in dimensions]
-            stat = pyrfr.util.weighted_running_stats()
-
-            prod_midpoints = it.product(*midpoints)
-            prod_sizes = it.product(*sizes)
-
-            sample = np.full(self.n_dims, np.nan, dtype=float)
-
-            # make prediction for all midpoints and weigh them by the corresponding size
-            for i, (m, s) in enumerate(zip(prod_midpoints, prod_sizes)):
-                sample[list(dimensions)] = list(m)
-                ls = self.the_forest.marginal_prediction_stat_of_tree(tree_idx, sample.tolist())
-                # self.logger.debug("%s, %s", (sample, ls.mean()))
-                if not np.isnan(ls.mean()):
-                    stat.push(ls.mean(), np.prod(np.array(s)) * ls.sum_of_weights())
-
-            # line 10 in algorithm 2
-            # note that V_U^2 can be computed by var(\hat a)^2 - \sum_{subU} var(f_subU)^2
-            # which is why, \hat{f} is never computed in the code, but
-            # appears in the pseudocode
-            V_U_total = np.nan
-            V_U_individual = np.nan
-
-            if stat.sum_of_weights() > 0:
-                V_U_total = stat.variance_population()
-                V_U_individual = stat.variance_population()
-                for k in range(1, len(dimensions)):
-                    for sub_dims in it.combinations(dimensions, k):
-                        V_U_individual -= self.V_U_individual[sub_dims][tree_idx]
-                V_U_individual = np.clip(V_U_individual, 0, np.inf)
-
-            self.V_U_individual[dimensions].append(V_U_individual)
-            self.V_U_total[dimensions].append(V_U_total)
+                V_U_individual -= self.V_U_individual[sub_dims]
+        # nan (i.e. the tree's predictions are cut off) is kept
+        V_U_individual = np.clip(V_U_individual, 0, np.inf)
+
+        # store both at once, so that a single lookup tells whether the marginal has been computed
+        self.V_U_individual[dimensions] = V_U_individual
+        self.V_U_total[dimensions] = V_U_total
+
+    def _variance_fractions(self, dimensions):
+        """
+        Returns the fractions of the trees' total variance explained by a (computed) marginal
+
+        Parameters
+        ----------
+        dimensions: tuple
+            Contains the indices of ConfigSpace for the selected parameters (starts with 0)
+
+        Returns
+        -------
+        tuple
+            individual and total fractions for all trees with non-zero total variance
+        """
+        # clean here to catch zero variance in a trees
+        non_zero_idx = self._non_zero_trees
+        if len(non_zero_idx) == 0:
+            raise RuntimeError('Encountered zero total variance in all trees.')
+        total_variances = self.trees_total_variance[non_zero_idx]
+
+        dimensions = tuple(sorted(dimensions))
+        fractions_individual = self.V_U_individual[dimensions][non_zero_idx] / total_variances
+        fractions_total = self.V_U_total[dimensions][non_zero_idx] / total_variances
+        return fractions_individual, fractions_total
 
     def quantify_importance(self, dims):
         if type(dims[0]) == str:
@@ -335,15 +531,7 @@ class fANOVA(object):
                     importance_dict[dim_names] = {}
                 else:
                     importance_dict[sub_dims] = {}
-                # clean here to catch zero variance in a trees
-                non_zero_idx = np.nonzero([self.trees_total_variance[t] for t in range(self.n_trees)])
-                if len(non_zero_idx[0]) == 0:
-                    raise RuntimeError('Encountered zero total variance in all trees.')
-
-                fractions_total = np.array([self.V_U_total[sub_dims][t] / self.trees_total_variance[t]
-                                            for t in non_zero_idx[0]])
-                fractions_individual = np.array([self.V_U_individual[sub_dims][t] / self.trees_total_variance[t]
-                                                 for t in non_zero_idx[0]])
+                fractions_individual, fractions_total = self._variance_fractions(sub_dims)
 
                 if type(dims[0]) == str:
                     importance_dict[dim_names]['individual importance'] = np.mean(fractions_individual)
@@ -375,11 +563,39 @@ class fANOVA(object):
         tuple 
             marginal mean prediction and corresponding variance estimate
         """
-        sample = np.full(self.n_dims, np.nan, dtype=np.float)
-        for i in range(len(dimlist)):
-            sample[dimlist[i]] = values_to_predict[i]
+        means, variances = self.marginal_mean_variance_for_values_batched(dimlist, [values_to_predict])
+        return means[0], variances[0]
+
+    def marginal_mean_variance_for_values_batched(self, dimlist, values_to_predict):
+        """
+        Returns the marginal of selected parameters for many values at once
 
-        return self.the_forest.marginal_mean_variance_prediction(sample)
+        Parameters
+        ----------
+        dimlist: list
+                Contains the indices of ConfigSpace for the selected parameters
+                (starts with 0)
+        values_to_predict: array-like
+                Matrix of shape (number of samples, len(dimlist)), each row
+                contains the values to be predicted
+
+        Returns
+        -------
+        tuple
+            arrays with the marginal mean predictions and the corresponding variance estimates
+        """
+        values_to_predict = np.atleast_2d(np.asarray(values_to_predict, dtype=np.float64))
+        if values_to_predict.ndim != 2 or values_to_predict.shape[1] != len(dimlist):
+            raise ValueError("Expected values_to_predict of shape (number of samples, %i), got %s"
+                             % (len(dimlist), str(values_to_predict.shape)))
+        samples = np.full((len(values_to_predict), self.n_dims), np.nan, dtype=np.float64)
+        samples[:, list(dimlist)] = values_to_predict
+
+        means = np.empty(len(samples))
+        variances = np.empty(len(samples))
+        for i, sample in enumerate(samples.tolist()):
+            means[i], variances[i] = self.the_forest.marginal_mean_variance_prediction(sample)
+        return means, variances
 
     def get_most_important_pairwise_marginals(self, params=None, n=10):
         """
@@ -414,9 +630,12 @@ class fANOVA(object):
         pairs = [x for x in it.combinations(dimensions, 2)]
         if params:
             n = len(list(pairs))
+        # the main effects are shared by all pairs, compute them once up front
+        for dim in dimensions:
+            self.__compute_marginals((dim,))
         for combi in pairs:
-            pairwise_marginal_performance = self.quantify_importance(combi)
-            tot_imp = pairwise_marginal_performance[combi]['individual importance']
+            self.__compute_marginals(combi)
+            tot_imp = np.mean(self._variance_fractions(combi)[0])
             combi_names = [self.cs_params[combi[0]].name, self.cs_params[combi[1]].name]
             pairwise_marginals.append((tot_imp, combi_names[0], combi_names[1]))
 
@@ -457,9 +676,13 @@ class fANOVA(object):
             dimensions = params
 
         triplets = [x for x in it.combinations(dimensions, 3)]
+        # the lower order effects are shared between the triplets, compute each of them once up front
+        for k in (1, 2):
+            for sub_dims in it.combinations(dimensions, k):
+                self.__compute_marginals(sub_dims)
         for combi in triplets:
-            triple_marginal_performance = self.quantify_importance(combi)
-            tot_imp = triple_marginal_performance[combi]['individual importance']
+            self.__compute_marginals(combi)
+            tot_imp = np.mean(self._variance_fractions(combi)[0])
             combi_names = [self.cs_params[combi[0]].name, self.cs_params[combi[1]].name, self.cs_params[combi[2]].name]
             triple_marginals.append((tot_imp, combi_names[0], combi_names[1], combi_names[2]))
 
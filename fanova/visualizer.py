@@ -124,10 +124,10 @@ class Visualizer(object):
         grid_fanova = grid_fanova.reshape([s for i, s in enumerate(grid_fanova.shape) if i in [0, 1] or s != 1])
 
         # Populating the result
-        zz = np.zeros((len(grid_fanova[0]), len(grid_fanova[1])))
-        for i, x_value in enumerate(grid_fanova[0]):
-            for j, y_value in enumerate(grid_fanova[1]):
-                zz[i][j] = self.fanova.marginal_mean_variance_for_values(param_indices, [x_value, y_value])[0]
+        xx, yy = np.meshgrid(grid_fanova[0], grid_fanova[1], indexing='ij')
+        zz = self.fanova.marginal_mean_variance_for_values_batched(param_indices,
+                                                                   np.column_stack([xx.ravel(), yy.ravel()]))[0]
+        zz = zz.reshape(xx.shape)
 
         return grid_orig, zz
 
@@ -275,14 +275,8 @@ class Visualizer(object):
 
             else:
                 grid = np.linspace(lower_bound, upper_bound, resolution)
-            mean = np.zeros(resolution)
-            std = np.zeros(resolution)
-
-            dim = [p_idx]
-            for i in range(0, resolution):
-                (m, v) = self.fanova.marginal_mean_variance_for_values(dim, [grid[i]])
-                mean[i] = m
-                std[i] = np.sqrt(v)
+            mean, v = self.fanova.marginal_mean_variance_for_values_batched([p_idx], grid.reshape(-1, 1))
+            std = np.sqrt(v)
             return mean, std, grid
 
         else:
@@ -294,8 +288,8 @@ class Visualizer(object):
                 categorical_size = len(p.sequence)
             else:
                 raise ValueError("Parameter %s of type %s not supported." % (p.name, type(p)))
-            marginals = [self.fanova.marginal_mean_variance_for_values([p_idx], [i]) for i in range(categorical_size)]
-            mean, v = list(zip(*marginals))
+            mean, v = self.fanova.marginal_mean_variance_for_values_batched([p_idx],
+                                                                           np.arange(categorical_size).reshape(-1, 1))
             std = np.sqrt(v)
             return mean, std
 
@@ -48,7 +48,29 @@ class TestfANOVAtoyData(unittest.TestCase):
 		print(f.trees_total_variance)
 		
 		print(f.V_U)
-		
+
+	def test_marginal_mean_variance_for_values_batched(self):
+
+		f = fanova.fANOVA(self.X,self.y,self.cfs, bootstrapping=False, n_trees=1, seed=5, max_features=1)
+
+		values = np.array([[10., 0], [50., 1], [90., 2]])
+		means, variances = f.marginal_mean_variance_for_values_batched([0, 1], values)
+		self.assertEqual(means.shape, (3,))
+		self.assertEqual(variances.shape, (3,))
+		for value, mean, variance in zip(values, means, variances):
+			m, v = f.marginal_mean_variance_for_values([0, 1], list(value))
+			self.assertAlmostEqual(mean, m)
+			self.assertAlmostEqual(variance, v)
+
+		# marginalizing over all dimensions
+		m, v = f.marginal_mean_variance_for_values([], [])
+		self.assertFalse(np.isnan(m))
+		self.assertFalse(np.isnan(v))
+
+		# one row per dimension instead of one per sample
+		with self.assertRaises(ValueError):
+			f.marginal_mean_variance_for_values_batched([0, 1], values.T)
+
 
 if __name__ == '__main__':
 	unittest.main()